@@ -2,19 +2,80 @@
 Melody-Annotator Backend
 使用 FastAPI + pretty_midi 实现 MIDI 旋律分离
 """
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Header, Request, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from typing import List, Dict
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Dict, Iterator, Optional, Tuple, Union
 import pretty_midi
 import numpy as np
-import tempfile
-import os
+import orjson
 import io
+import json
 import zipfile
+import os
+import asyncio
+import hashlib
+import multiprocessing
+import struct
+from collections import OrderedDict
+from operator import attrgetter, itemgetter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pydantic import BaseModel
 
-app = FastAPI(title="Melody Annotator API")
+try:
+    import numba
+except ImportError:  # numba 为可选依赖：未安装时使用纯 Python 实现
+    numba = None
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """启动时预编译 numba 函数并启动进程池，退出时关闭进程池"""
+    # Token 解码在主进程执行；先在主进程编译，工作进程随后可直接加载磁盘缓存
+    _warm_up_jit()
+    # 进程池按需启动工作进程：提交与进程数相同的空任务，让 initializer 在首个请求之前完成
+    await asyncio.gather(*(_run_in_executor(int) for _ in range(os.cpu_count() or 1)))
+    yield
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="Melody Annotator API", lifespan=_lifespan)
+
+# 上传 MIDI 文件的大小上限（字节）
+MAX_MIDI_BYTES = 20 * 1024 * 1024
+
+# /tokenize_bin 请求头：音符数 (uint32)、时间量化 (uint32)、总时长 (float64)，小端
+TOKENIZE_BIN_HEADER = struct.Struct('<IId')
+
+# /upload 结果缓存：{文件内容哈希: JSON 响应体}，按 LRU 淘汰
+# 响应体可达 MIDI 文件的十几倍，除条目数外同时限制总字节数；过大的单个响应体不缓存
+UPLOAD_CACHE_SIZE = 64
+UPLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024
+UPLOAD_CACHE_ENTRY_MAX_BYTES = 32 * 1024 * 1024
+_upload_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+_upload_cache_bytes = 0
+_upload_pending: Dict[bytes, "asyncio.Future[bytes]"] = {}
+
+# CPU 密集的解析/Skyline/Token化放到进程池执行，绕开 GIL 且不阻塞事件循环
+# 不从已启动线程的服务进程 fork 子进程：优先 forkserver，不支持时（如 Windows）退回 spawn
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def _new_executor() -> ProcessPoolExecutor:
+    """创建 CPU 密集任务使用的进程池（每个工作进程启动时预编译 numba 函数）"""
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=MP_CONTEXT,
+                               initializer=_warm_up_jit)
+
+
+# 首次使用时才创建：工作进程会重新导入本模块，不应各自再建一个进程池
+EXECUTOR: Optional[ProcessPoolExecutor] = None
 
 # 配置 CORS
 app.add_middleware(
@@ -25,6 +86,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# /upload、/tokenize 等 JSON 响应体积大且重复度高，超过 1KB 时 gzip 压缩；
+# /export 的 ZIP 通过 Content-Encoding: identity 跳过，避免重复压缩
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 
 class Note(BaseModel):
     """音符数据模型"""
@@ -77,33 +142,209 @@ class TokenizeSlicedRequest(BaseModel):
     overlap: float = 0.0  # 切片之间的重叠时间（秒）
 
 
-def slice_notes_by_time(notes: List[Dict], start_time: float, end_time: float) -> List[Dict]:
+def _int_column(notes: list, field) -> np.ndarray:
     """
-    根据时间范围切片音符
+    取出每个音符的整数字段，通常为 int64 数组
     
-    Args:
-        notes: 音符列表
-        start_time: 切片开始时间
-        end_time: 切片结束时间
+    请求校验允许任意大小的 int：存在超出 int64 的值时退回 object 数组保留原值，
+    与逐个 Python 整数处理的结果一致
+    """
+    try:
+        return np.fromiter(map(field, notes), np.int64, len(notes))
+    except OverflowError:
+        return np.array([field(note) for note in notes], dtype=object)
+
+
+@dataclass
+class _NoteArrays:
+    """音符的 SoA (Structure of Arrays) 表示，各字段为等长的 NumPy 数组"""
+    starts: np.ndarray
+    ends: np.ndarray
+    pitches: np.ndarray
+    velocities: np.ndarray
+    is_melody: np.ndarray
     
-    Returns:
-        在时间范围内的音符列表（时间已调整为相对于start_time）
+    # from_buffer 中每个音符占用的字节数（2 个 float64 + 3 个 uint8）
+    BYTES_PER_NOTE = 2 * 8 + 3
+    
+    def __len__(self) -> int:
+        return len(self.starts)
+    
+    @classmethod
+    def from_dicts(cls, notes: List[Dict]) -> "_NoteArrays":
+        """从音符字典列表构建"""
+        count = len(notes)
+        return cls(
+            starts=np.fromiter((note['start'] for note in notes), np.float64, count),
+            ends=np.fromiter((note['end'] for note in notes), np.float64, count),
+            pitches=_int_column(notes, itemgetter('pitch')),
+            velocities=_int_column(notes, itemgetter('velocity')),
+            is_melody=np.fromiter((bool(note['is_melody']) for note in notes), np.bool_, count)
+        )
+    
+    @classmethod
+    def from_models(cls, notes: List[Note]) -> "_NoteArrays":
+        """从请求中的 Note 模型列表构建（直接读取属性，不经过 .dict()）"""
+        count = len(notes)
+        return cls(
+            starts=np.fromiter((note.start for note in notes), np.float64, count),
+            ends=np.fromiter((note.end for note in notes), np.float64, count),
+            pitches=_int_column(notes, attrgetter('pitch')),
+            velocities=_int_column(notes, attrgetter('velocity')),
+            is_melody=np.fromiter((note.is_melody for note in notes), np.bool_, count)
+        )
+    
+    @classmethod
+    def from_instruments(cls, instruments: List[pretty_midi.Instrument]) -> "_NoteArrays":
+        """从 pretty_midi 乐器轨道构建（按轨道顺序拼接），is_melody 默认为 False"""
+        notes = [note for instrument in instruments for note in instrument.notes]
+        count = len(notes)
+        return cls(
+            starts=np.fromiter((note.start for note in notes), np.float64, count),
+            ends=np.fromiter((note.end for note in notes), np.float64, count),
+            pitches=np.fromiter((note.pitch for note in notes), np.int64, count),
+            velocities=np.fromiter((note.velocity for note in notes), np.int64, count),
+            is_melody=np.zeros(count, dtype=np.bool_)
+        )
+    
+    @classmethod
+    def from_buffer(cls, buffer: bytes, count: int, offset: int = 0) -> "_NoteArrays":
+        """
+        从小端二进制 SoA 数据构建：依次为 starts (<f8)、ends (<f8)、
+        pitches (u1)、velocities (u1)、is_melody (u1)，每个数组 count 个元素
+        
+        Raises:
+            ValueError: 数据长度与 count 不符
+        """
+        if len(buffer) - offset != count * cls.BYTES_PER_NOTE:
+            raise ValueError(f"数据长度应为 {count * cls.BYTES_PER_NOTE} 字节，实际为 {len(buffer) - offset} 字节")
+        starts = np.frombuffer(buffer, '<f8', count, offset)
+        ends = np.frombuffer(buffer, '<f8', count, offset + 8 * count)
+        pitches, velocities, is_melody = np.frombuffer(buffer, np.uint8, 3 * count, offset + 16 * count).reshape(3, count)
+        return cls(
+            starts=starts.astype(np.float64),
+            ends=ends.astype(np.float64),
+            pitches=pitches.astype(np.int64),
+            velocities=velocities.astype(np.int64),
+            is_melody=is_melody.astype(np.bool_)
+        )
+    
+    def take(self, indices: np.ndarray) -> "_NoteArrays":
+        """按下标选取音符（保持下标给出的顺序）"""
+        return _NoteArrays(
+            starts=self.starts[indices],
+            ends=self.ends[indices],
+            pitches=self.pitches[indices],
+            velocities=self.velocities[indices],
+            is_melody=self.is_melody[indices]
+        )
+    
+    def slice_by_time(self, start_time: float, end_time: float) -> "_NoteArrays":
+        """
+        按时间范围切片：保留 start < end_time 且 end > start_time 的音符，
+        时间调整为相对于 start_time 并裁剪到 [0, end_time - start_time]
+        """
+        mask = (self.starts < end_time) & (self.ends > start_time)
+        return _NoteArrays(
+            starts=np.maximum(0, self.starts[mask] - start_time),
+            ends=np.minimum(end_time - start_time, self.ends[mask] - start_time),
+            pitches=self.pitches[mask],
+            velocities=self.velocities[mask],
+            is_melody=self.is_melody[mask]
+        )
+    
+    def to_dicts(self) -> List[Dict]:
+        """转换为音符字典列表（id 按顺序编号），仅在 JSON 响应边界使用"""
+        return [
+            {'id': i, 'start': start, 'end': end, 'pitch': pitch, 'velocity': velocity, 'is_melody': is_melody}
+            for i, (start, end, pitch, velocity, is_melody) in enumerate(zip(
+                self.starts.tolist(), self.ends.tolist(), self.pitches.tolist(),
+                self.velocities.tolist(), self.is_melody.tolist()
+            ))
+        ]
+
+
+@dataclass
+class _StartIndex:
+    """按开始时间排序的音符索引，用于快速查找与时间范围相交的候选音符"""
+    order: np.ndarray
+    sorted_starts: np.ndarray
+    max_length: float
+    
+    @classmethod
+    def from_arrays(cls, arrays: _NoteArrays) -> "_StartIndex":
+        """对开始时间排序一次，记录最长音符时长"""
+        order = np.argsort(arrays.starts, kind='stable')
+        max_length = float((arrays.ends - arrays.starts).max()) if len(arrays) else 0.0
+        return cls(order=order, sorted_starts=arrays.starts[order], max_length=max(max_length, 0.0))
+    
+    def candidates(self, start_time: float, end_time: float) -> np.ndarray:
+        """
+        返回可能与 [start_time, end_time) 相交的音符下标（升序，保持原始顺序）
+        
+        开始时间早于 start_time - max_length 的音符必然在 start_time 之前结束；
+        下界额外留出浮点余量，精确筛选仍由 slice_by_time 完成
+        """
+        lower = start_time - self.max_length * 1.000001 - 1e-6
+        lo = np.searchsorted(self.sorted_starts, lower, side='left')
+        hi = np.searchsorted(self.sorted_starts, end_time, side='left')
+        return np.sort(self.order[lo:hi])
+
+
+def _to_builtin(content):
+    """递归地将 NumPy 数组/标量转换为 Python 内置类型，供标准库 json 序列化"""
+    if isinstance(content, dict):
+        return {key: _to_builtin(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [_to_builtin(value) for value in content]
+    if isinstance(content, (np.ndarray, np.generic)):
+        return content.tolist()
+    return content
+
+
+def _dump_json(content) -> bytes:
     """
-    sliced_notes = []
+    使用 orjson 序列化为 JSON 字节串（NumPy 数组可直接序列化）
     
-    for note in notes:
-        # 检查音符是否在时间范围内
-        if note['start'] < end_time and note['end'] > start_time:
-            # 调整音符时间为相对于切片开始时间
-            adjusted_note = note.copy()
-            adjusted_note['start'] = max(0, note['start'] - start_time)
-            adjusted_note['end'] = min(end_time - start_time, note['end'] - start_time)
-            sliced_notes.append(adjusted_note)
+    orjson 不支持超出 64 位的整数（请求校验允许任意大小的 int）与 object 数组，
+    遇到时退回标准库 json（与 FastAPI 默认 JSONResponse 的参数一致），结果不受快速路径影响
+    """
+    try:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    except orjson.JSONEncodeError:
+        return json.dumps(
+            _to_builtin(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+
+
+def _json_response(content) -> Response:
+    """
+    返回 orjson 序列化的 JSON 响应，content 为 bytes 时视为已序列化的 JSON
     
-    return sliced_notes
+    直接返回 Response 可以跳过 FastAPI 对返回值逐字段的 jsonable_encoder 遍历，
+    对包含成千上万个音符/Token 的响应尤其明显
+    """
+    if not isinstance(content, bytes):
+        content = _dump_json(content)
+    return Response(content=content, media_type="application/json")
 
 
-def extract_target_tokens(training_sequence: List[int]) -> List[int]:
+# 事件 Token 查找表：EVENT_TOKENS[is_melody][is_off]
+# 伴奏 NOTE_ON/NOTE_OFF = 20/21，旋律 NOTE_ON/NOTE_OFF = 10/11
+EVENT_TOKENS = np.array([[20, 21], [10, 11]], dtype=np.int64)
+
+# tokens_to_notes 的分派表：{token: 处理类型}，不在表中的 Token（含 <BOS>/<SEP>/<EOS>）直接跳过
+TOKEN_SKIP, TOKEN_TIME, TOKEN_NOTE_ON, TOKEN_NOTE_OFF = 0, 1, 2, 3
+TOKEN_KINDS = {0: TOKEN_TIME, 10: TOKEN_NOTE_ON, 20: TOKEN_NOTE_ON, 11: TOKEN_NOTE_OFF, 21: TOKEN_NOTE_OFF}
+NOTE_EVENT_TOKENS = frozenset((10, 11, 20, 21))
+
+# 数组形式的分派表（供 numba 版本使用），超出范围的 Token 同样跳过
+TOKEN_KIND_TABLE = np.zeros(32, dtype=np.int64)
+for _token, _kind in TOKEN_KINDS.items():
+    TOKEN_KIND_TABLE[_token] = _kind
+
+
+def extract_target_tokens(training_sequence: Union[List[int], np.ndarray]) -> np.ndarray:
     """
     从training_sequence中只提取Target部分
     
@@ -111,34 +352,188 @@ def extract_target_tokens(training_sequence: List[int]) -> List[int]:
     返回: Target部分 (不包含SEP和EOS)
     
     Args:
-        training_sequence: 完整的训练序列
+        training_sequence: 完整的训练序列（列表或 NumPy 数组）
     
     Returns:
-        只包含Target的token序列
+        只包含Target的token序列（NumPy 数组视图，不复制数据）
     """
-    try:
-        # 找到SEP (Token ID=2)的位置
-        sep_index = training_sequence.index(2)
-        
+    sequence = np.asarray(training_sequence)
+    
+    # 找到SEP (Token ID=2)的位置：向量化比较代替 list.index 的逐个比较
+    is_sep = sequence == 2
+    if is_sep.any():
         # 提取SEP之后的部分
-        target_tokens = training_sequence[sep_index + 1:]
+        target_tokens = sequence[int(np.argmax(is_sep)) + 1:]
         
         # 去掉末尾的EOS (Token ID=3)
-        if target_tokens and target_tokens[-1] == 3:
+        if len(target_tokens) and target_tokens[-1] == 3:
             target_tokens = target_tokens[:-1]
         
         return target_tokens
-    except ValueError:
-        # 如果没有SEP，返回整个序列（去掉BOS和EOS）
-        result = training_sequence[:]
-        if result and result[0] == 1:  # 去掉BOS
-            result = result[1:]
-        if result and result[-1] == 3:  # 去掉EOS
-            result = result[:-1]
-        return result
+    
+    # 如果没有SEP，返回整个序列（去掉BOS和EOS）
+    result = sequence
+    if len(result) and result[0] == 1:  # 去掉BOS
+        result = result[1:]
+    if len(result) and result[-1] == 3:  # 去掉EOS
+        result = result[:-1]
+    return result
 
 
-def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict]:
+if numba is not None:
+    # 超出 0-127 的异常音高的活跃音符: (开始时间, 是否旋律, 插入序号)
+    _ACTIVE_NOTE_TYPE = numba.types.Tuple((numba.types.float64, numba.types.boolean, numba.types.int64))
+    
+    @numba.njit(cache=True)
+    def _tokens_to_notes_jit(tokens: np.ndarray, time_quantization: int):
+        """
+        tokens_to_notes 的 numba 编译版本，状态机逻辑与纯 Python 版本逐条一致
+        
+        Returns:
+            按生成顺序排列的 (starts, ends, pitches, is_melody) 数组（尚未按开始时间排序）
+        """
+        # 每个音符至少对应一个 NOTE_ON（两个 token），不会超过 len(tokens) // 2 个
+        capacity = len(tokens) // 2
+        starts = np.empty(capacity, dtype=np.float64)
+        ends = np.empty(capacity, dtype=np.float64)
+        pitches = np.empty(capacity, dtype=np.int64)
+        is_melody = np.empty(capacity, dtype=np.bool_)
+        count = 0
+        
+        # MIDI 音高 0-127 的活跃音符存放在定长数组中，插入序号 -1 表示空闲；
+        # 插入序号用于按插入顺序清理残余音符（与 dict 的顺序一致）
+        slot_start = np.zeros(128, dtype=np.float64)
+        slot_melody = np.zeros(128, dtype=np.bool_)
+        slot_sequence = np.full(128, -1, dtype=np.int64)
+        # 异常 Token 流中超出范围的音高退回字典: {pitch: (开始时间, 是否旋律, 插入序号)}
+        other_notes = numba.typed.Dict.empty(numba.types.int64, _ACTIVE_NOTE_TYPE)
+        sequence = 0
+        current_time = 0.0
+        min_duration = time_quantization / 1000.0 * 0.5
+        
+        n = len(tokens)
+        i = 0
+        while i < n:
+            token = tokens[i]
+            kind = TOKEN_KIND_TABLE[token] if 0 <= token < len(TOKEN_KIND_TABLE) else TOKEN_SKIP
+            
+            if kind == TOKEN_SKIP:
+                i += 1
+            
+            elif kind == TOKEN_TIME:
+                if i + 1 < n:
+                    val = tokens[i + 1]
+                    if 0 <= val < len(TOKEN_KIND_TABLE) and TOKEN_KIND_TABLE[val] >= TOKEN_NOTE_ON:
+                        i += 1
+                    else:
+                        current_time += (val * time_quantization) / 1000.0
+                        i += 2
+                else:
+                    i += 1
+            
+            elif i + 1 >= n:
+                i += 1
+            
+            else:
+                # NOTE_ON / NOTE_OFF：取出该音高的活跃音符（若存在）
+                pitch = tokens[i + 1]
+                prev_start = 0.0
+                prev_melody = False
+                if 0 <= pitch < 128:
+                    has_prev = slot_sequence[pitch] >= 0
+                    if has_prev:
+                        prev_start = slot_start[pitch]
+                        prev_melody = slot_melody[pitch]
+                        slot_sequence[pitch] = -1
+                else:
+                    has_prev = pitch in other_notes
+                    if has_prev:
+                        prev_start, prev_melody, _ = other_notes.pop(pitch)
+                
+                if kind == TOKEN_NOTE_ON:
+                    # 同音覆盖：上一个音在此结束（仅保存时长 > 0 的音符）
+                    if has_prev and current_time > prev_start:
+                        starts[count] = prev_start
+                        ends[count] = current_time
+                        pitches[count] = pitch
+                        is_melody[count] = prev_melody
+                        count += 1
+                    if 0 <= pitch < 128:
+                        slot_start[pitch] = current_time
+                        slot_melody[pitch] = token == 10
+                        slot_sequence[pitch] = sequence
+                    else:
+                        other_notes[pitch] = (current_time, token == 10, sequence)
+                    sequence += 1
+                
+                elif has_prev:
+                    end_t = current_time
+                    if end_t <= prev_start:
+                        end_t = prev_start + min_duration
+                    starts[count] = prev_start
+                    ends[count] = end_t
+                    pitches[count] = pitch
+                    is_melody[count] = prev_melody
+                    count += 1
+                i += 2
+        
+        # 残余音符按插入顺序在 current_time 关闭
+        slot_pitches = np.flatnonzero(slot_sequence >= 0)
+        remaining = len(slot_pitches) + len(other_notes)
+        left_pitches = np.empty(remaining, dtype=np.int64)
+        left_starts = np.empty(remaining, dtype=np.float64)
+        left_melody = np.empty(remaining, dtype=np.bool_)
+        left_sequence = np.empty(remaining, dtype=np.int64)
+        k = 0
+        for pitch in slot_pitches:
+            left_pitches[k] = pitch
+            left_starts[k] = slot_start[pitch]
+            left_melody[k] = slot_melody[pitch]
+            left_sequence[k] = slot_sequence[pitch]
+            k += 1
+        for pitch, info in other_notes.items():
+            left_pitches[k] = pitch
+            left_starts[k] = info[0]
+            left_melody[k] = info[1]
+            left_sequence[k] = info[2]
+            k += 1
+        for k in np.argsort(left_sequence):
+            end_t = current_time
+            if end_t <= left_starts[k]:
+                end_t = left_starts[k] + min_duration
+            starts[count] = left_starts[k]
+            ends[count] = end_t
+            pitches[count] = left_pitches[k]
+            is_melody[count] = left_melody[k]
+            count += 1
+        
+        return starts[:count], ends[:count], pitches[:count], is_melody[:count]
+
+
+def _tokens_to_jit_array(tokens: List[int], time_quantization: int) -> Optional[np.ndarray]:
+    """
+    将 Token 序列转换为 int64 数组供编译版本使用
+    
+    Returns:
+        int64 数组；numba 不可用，或 Token 过大会导致 TIME 计算溢出 int64 时返回 None
+    """
+    if numba is None:
+        return None
+    try:
+        token_array = np.asarray(tokens)
+    except (OverflowError, TypeError, ValueError):
+        return None
+    # 非整数（如浮点、超出 int64 的大整数对象）交给纯 Python 版本处理
+    if token_array.ndim != 1 or (len(token_array) and token_array.dtype.kind not in 'biu'):
+        return None
+    if len(token_array):
+        bound = max(abs(int(token_array.min())), abs(int(token_array.max())))
+        if bound * max(abs(int(time_quantization)), 1) >= 2 ** 63:
+            return None
+    return token_array.astype(np.int64)
+
+
+def tokens_to_notes(tokens: Union[List[int], np.ndarray], time_quantization: int = 10) -> List[Dict]:
     """
     将Token序列逆转换为MIDI音符列表（修复版）
     
@@ -165,6 +560,24 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
     Returns:
         音符列表
     """
+    token_array = _tokens_to_jit_array(tokens, time_quantization)
+    if token_array is not None:
+        starts, ends, pitches, is_melody = _tokens_to_notes_jit(token_array, int(time_quantization))
+        # id 为生成顺序，再按开始时间稳定排序（与 list.sort 一致；
+        # 浮点数组的 stable 排序为 Timsort，对基本有序的数据接近线性）
+        order = np.argsort(starts, kind='stable')
+        return [
+            {'id': note_id, 'start': start, 'end': end, 'pitch': pitch, 'velocity': 80, 'is_melody': melody}
+            for note_id, start, end, pitch, melody in zip(
+                order.tolist(), starts[order].tolist(), ends[order].tolist(),
+                pitches[order].tolist(), is_melody[order].tolist()
+            )
+        ]
+    
+    # 纯 Python 版本逐个读取 Token，先转为列表避免 NumPy 标量开销
+    if isinstance(tokens, np.ndarray):
+        tokens = tokens.tolist()
+    
     notes = []
     active_notes = {}  # {pitch: {'start': time, 'is_melody': bool}}
     current_time = 0.0
@@ -176,21 +589,22 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
     i = 0
     while i < len(tokens):
         token = tokens[i]
+        kind = TOKEN_KINDS.get(token, TOKEN_SKIP)
         
-        # 跳过特殊标记
-        if token in [1, 2, 3]:  # <BOS>, <SEP>, <EOS>
+        # 跳过特殊标记 <BOS>, <SEP>, <EOS> 及未知token
+        if kind == TOKEN_SKIP:
             i += 1
             continue
         
         # -------------------------------------------------------
         # 1. TIME事件
         # -------------------------------------------------------
-        if token == 0:
+        if kind == TOKEN_TIME:
             if i + 1 < len(tokens):
                 val = tokens[i + 1]
                 # 【鲁棒性保护】如果后面跟的不是时间数值，而是其他命令
                 # 假设event ID都在10以上，时间偏移通常较小
-                if val in [10, 11, 20, 21]:
+                if val in NOTE_EVENT_TOKENS:
                     time_delta = 0
                     i += 1
                 else:
@@ -203,7 +617,7 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
         # -------------------------------------------------------
         # 2. NOTE_ON (旋律=10, 伴奏=20)
         # -------------------------------------------------------
-        elif token in [10, 20]:
+        elif kind == TOKEN_NOTE_ON:
             is_melody = (token == 10)
             if i + 1 < len(tokens):
                 pitch = tokens[i + 1]
@@ -239,7 +653,7 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
         # -------------------------------------------------------
         # 3. NOTE_OFF (旋律=11, 伴奏=21)
         # -------------------------------------------------------
-        elif token in [11, 21]:
+        else:
             # 不区分Melody Off还是Accomp Off，只要pitch对上了就关
             if i + 1 < len(tokens):
                 pitch = tokens[i + 1]
@@ -265,10 +679,6 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
                 i += 2
             else:
                 i += 1
-        
-        else:
-            # 未知token，跳过
-            i += 1
     
     # 【修复3：清理残余音符】
     # 如果序列结束了，active_notes里还有没关掉的音符
@@ -290,11 +700,302 @@ def tokens_to_notes(tokens: List[int], time_quantization: int = 10) -> List[Dict
         note_id += 1
     
     # 最后按开始时间排序
-    notes.sort(key=lambda x: x['start'])
+    # 音符按结束顺序生成（长音晚于其后开始的短音），并不是按开始时间有序的；
+    # list.sort 的 Timsort 会识别已有序的片段并线性归并，残余音符只是末尾的一小段，
+    # 因此不另外做归并，只把 lambda 换成 C 实现的 itemgetter
+    notes.sort(key=itemgetter('start'))
     return notes
 
 
-def midi_to_tokens(notes: List[Dict], duration: float, time_quantization: int = 10, 
+# tokens_to_midi_bytes 的输出格式，与 pretty_midi.PrettyMIDI() 的默认值一致：
+# 分辨率 220 tick/拍，120 BPM，音符力度 80
+MIDI_RESOLUTION = 220
+MIDI_TICK_SCALE = 60.0 / (120.0 * MIDI_RESOLUTION)
+
+
+def _encode_variable_ints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    向量化的 MIDI 变长整数编码
+    
+    Returns:
+        (每个值的编码字节数, 每个值的 7 位分组，按高位在前排列，形状为 (len, 10))
+    """
+    values = values.astype(np.int64)
+    # 每 7 位一组，int64 最多 10 组
+    shifts = 7 * np.arange(9, -1, -1)
+    groups = (values[:, None] >> shifts) & 0x7F
+    # 编码字节数 = 从最高的非零分组开始计数（0 也占 1 个字节）
+    sizes = 10 - np.argmax(groups != 0, axis=1)
+    sizes[values == 0] = 1
+    return sizes, groups
+
+
+def _encode_variable_bytes(value: int) -> bytes:
+    """单个整数的 MIDI 变长编码"""
+    sizes, groups = _encode_variable_ints(np.array([value]))
+    size = int(sizes[0])
+    encoded = groups[0, 10 - size:].astype(np.uint8)
+    encoded[:-1] |= 0x80
+    return encoded.tobytes()
+
+
+def _midi_note_track_bytes(starts: np.ndarray, ends: np.ndarray, pitches: np.ndarray,
+                           name: str) -> bytes:
+    """
+    直接编码单轨钢琴 MIDI 文件（格式 1：速度轨 + 音符轨）
+    
+    事件排序、tick 取整与运行状态字节与 pretty_midi.write() 逐字节一致，
+    但不创建 Note/Message 对象，也不使用比较函数排序
+    
+    Args:
+        starts, ends: 音符开始/结束时间（秒）
+        pitches: MIDI 音高（0-127）
+        name: 音轨名称
+    """
+    count = len(starts)
+    times = np.concatenate((starts, ends))
+    # pretty_midi.time_to_tick：非正时间为 0，其余四舍六入五成双
+    ticks = np.where(times > 0, np.rint(times / MIDI_TICK_SCALE), 0).astype(np.int64)
+    event_pitches = np.concatenate((pitches, pitches))
+    velocities = np.concatenate((np.full(count, 80, np.int64), np.zeros(count, np.int64)))
+    
+    # 同一 tick 按音高、再按力度排序（力度 0 的 Note Off 在前）
+    order = np.lexsort((velocities, event_pitches, ticks))
+    ticks = ticks[order]
+    event_pitches = event_pitches[order]
+    velocities = velocities[order]
+    
+    # 每个事件：变长 delta + [状态字节] + 音高 + 力度；只有第一个 Note On 写出状态字节 0x90，
+    # 其余沿用运行状态
+    sizes, groups = _encode_variable_ints(np.diff(ticks, prepend=0))
+    event_sizes = sizes + 2
+    event_sizes[0] += 1
+    offsets = np.concatenate(([0], np.cumsum(event_sizes)[:-1]))
+    events = np.empty(int(event_sizes.sum()), dtype=np.uint8)
+    for g in range(int(sizes.max())):
+        has_group = sizes > g
+        group = groups[has_group, 10 - sizes[has_group] + g]
+        continued = (g < sizes[has_group] - 1) * 0x80
+        events[offsets[has_group] + g] = group | continued
+    data_offsets = offsets + sizes
+    events[data_offsets[0]] = 0x90
+    data_offsets[0] += 1
+    events[data_offsets] = event_pitches
+    events[data_offsets + 1] = velocities
+    
+    # 速度轨：set_tempo(500000) + 4/4 拍号，末尾 end_of_track 延后 1 tick
+    tempo = int(6e7 / (60. / (MIDI_TICK_SCALE * MIDI_RESOLUTION)))
+    timing_track = (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+                    + b'\x00\xff\x58\x04\x04\x02\x18\x08'
+                    + b'\x01\xff\x2f\x00')
+    track_name = name.encode('latin1')
+    note_track = (b'\x00\xff\x03' + _encode_variable_bytes(len(track_name)) + track_name
+                  + b'\x00\xc0\x00'
+                  + events.tobytes()
+                  + b'\x01\xff\x2f\x00')
+    
+    return b''.join((
+        b'MThd', struct.pack('>Lhhh', 6, 1, 2, MIDI_RESOLUTION),
+        b'MTrk', struct.pack('>L', len(timing_track)), timing_track,
+        b'MTrk', struct.pack('>L', len(note_track)), note_track
+    ))
+
+
+def tokens_to_midi_bytes(tokens: Union[List[int], np.ndarray], time_quantization: int = 10,
+                         name: str = "Piano") -> Optional[bytes]:
+    """
+    将Token序列直接编码为MIDI文件字节，结果与 tokens_to_notes + pretty_midi.write() 相同
+    
+    跳过音符字典与 pretty_midi.Note 对象，音符数组直接进入向量化编码
+    
+    Args:
+        tokens: Token序列
+        time_quantization: 时间量化单位（毫秒）
+        name: 音轨名称
+    
+    Returns:
+        MIDI 文件字节；没有解析出音符时返回 None
+    """
+    token_array = _tokens_to_jit_array(tokens, time_quantization)
+    if token_array is not None:
+        starts, ends, pitches, _ = _tokens_to_notes_jit(token_array, int(time_quantization))
+    else:
+        notes = tokens_to_notes(tokens, time_quantization)
+        starts = [n['start'] for n in notes]
+        ends = [n['end'] for n in notes]
+        pitches = [n['pitch'] for n in notes]
+    
+    if len(starts) == 0:
+        return None
+    
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    pitch_array = np.asarray(pitches)
+    in_range = (pitch_array.dtype.kind in 'iu'
+                and bool(((pitch_array >= 0) & (pitch_array <= 127)).all())
+                and float(max(starts.max(), ends.max())) / MIDI_TICK_SCALE < 2 ** 62)
+    if in_range:
+        return _midi_note_track_bytes(starts, ends, pitch_array.astype(np.int64), name)
+    
+    # 音高超出 MIDI 范围或时间过大：交给 pretty_midi（保持其原有的报错行为）
+    midi = pretty_midi.PrettyMIDI()
+    instrument = pretty_midi.Instrument(program=0, name=name)
+    instrument.notes = [
+        pretty_midi.Note(velocity=80, pitch=pitch, start=start, end=end)
+        for start, end, pitch in zip(starts.tolist(), ends.tolist(), list(pitches))
+    ]
+    midi.instruments.append(instrument)
+    midi_buffer = io.BytesIO()
+    midi.write(midi_buffer)
+    return midi_buffer.getvalue()
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _time_deltas_jit(times: np.ndarray, melody: np.ndarray, quantum: float):
+        """_time_deltas 的 numba 编译版本（运算顺序相同，结果逐位一致）"""
+        target_deltas = np.zeros(len(times), dtype=np.int64)
+        source_deltas = np.zeros(len(times), dtype=np.int64)
+        target_time = 0.0
+        source_time = 0.0
+        for i in range(len(times)):
+            time_delta = int((times[i] - target_time) * 1000.0 / quantum)
+            if time_delta > 0:
+                target_time = times[i]
+                target_deltas[i] = time_delta
+            if melody[i]:
+                time_delta = int((times[i] - source_time) * 1000.0 / quantum)
+                if time_delta > 0:
+                    source_time = times[i]
+                    source_deltas[i] = time_delta
+        return target_deltas, source_deltas
+
+
+def _time_deltas(times: np.ndarray, melody: np.ndarray,
+                 time_quantization: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    一次扫描同时计算 Target（全部事件）与 Source（仅旋律事件）中每个事件之前
+    需要输出的 TIME 偏移（0 表示不输出 TIME）
+    
+    TIME 事件只在时间差量化后大于0时输出，且只有输出TIME时才推进当前时间，
+    因此这里必须按顺序扫描；两个序列各自维护当前时间
+    
+    Args:
+        times: 事件时间（已排序）
+        melody: 事件是否属于旋律
+        time_quantization: 时间量化单位（毫秒）
+    
+    Returns:
+        (target_deltas, source_deltas)，均与 times 等长；非旋律事件的 source_delta 为 0
+    """
+    # 循环不变量提前转换为 float，避免每次混合类型运算；
+    # 运算顺序保持 (t - ct) * 1000 / q，改用倒数相乘会在量化格点上产生舍入差异
+    quantum = float(time_quantization)
+    if numba is not None:
+        return _time_deltas_jit(times, melody, quantum)
+    
+    target_deltas = []
+    source_deltas = []
+    target_time = 0.0
+    source_time = 0.0
+    for time, is_melody in zip(times.tolist(), melody.tolist()):
+        time_delta = int((time - target_time) * 1000.0 / quantum)
+        if time_delta > 0:
+            target_time = time
+            target_deltas.append(time_delta)
+        else:
+            target_deltas.append(0)
+        
+        time_delta = int((time - source_time) * 1000.0 / quantum) if is_melody else 0
+        if time_delta > 0:
+            source_time = time
+            source_deltas.append(time_delta)
+        else:
+            source_deltas.append(0)
+    
+    return np.array(target_deltas, dtype=np.int64), np.array(source_deltas, dtype=np.int64)
+
+
+def _events_to_tokens(deltas: np.ndarray, pitches: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """
+    将已排序的事件数组编码为数字 Token 序列
+    
+    每个事件占一行 [0, time_delta, code, pitch]，不需要 TIME 的行用布尔掩码去掉前两格，
+    按行展开即为 Token 序列（音高可能为任意整数，不能用取值作为占位标记）
+    
+    Args:
+        deltas: 每个事件之前的 TIME 偏移（见 _time_deltas）
+        pitches: 事件音高
+        codes: 事件 Token ID (10/11/20/21)
+    
+    Returns:
+        Token 数组
+    """
+    has_time = deltas > 0
+    
+    # 音高超出 int64 时为 object 数组（见 _int_column），Token 随之使用 object 保留原值
+    rows = np.zeros((len(deltas), 4), dtype=np.result_type(pitches, np.int64))  # TIME事件 = 0
+    rows[:, 1] = deltas
+    rows[:, 2] = codes
+    rows[:, 3] = pitches
+    
+    keep = np.ones(rows.shape, dtype=np.bool_)
+    keep[~has_time, :2] = False
+    return rows[keep]
+
+
+def _midi_to_token_arrays(notes: Union[List[Dict], _NoteArrays], time_quantization: int = 10,
+                          start_time: float = 0.0, end_time: float = None) -> Dict[str, np.ndarray]:
+    """
+    midi_to_tokens 的核心实现，返回 NumPy 数组（source、target、training_sequence）
+    
+    进程池 worker 直接返回数组，序列化开销远小于 Python 列表
+    """
+    arrays = notes if isinstance(notes, _NoteArrays) else _NoteArrays.from_dicts(notes)
+    
+    # 如果指定了切片时间，则进行切片
+    if end_time is not None:
+        arrays = arrays.slice_by_time(start_time, end_time)
+    
+    # 以 SoA 数组构建事件：前半为 NOTE_ON，后半为 NOTE_OFF
+    count = len(arrays)
+    
+    times = np.concatenate((arrays.starts, arrays.ends))
+    is_off = np.concatenate((np.zeros(count, np.int64), np.ones(count, np.int64)))
+    pitches = np.concatenate((arrays.pitches, arrays.pitches))
+    melody = np.concatenate((arrays.is_melody, arrays.is_melody))
+    
+    # 按时间排序，同一时间 NOTE_ON 在前（lexsort 为稳定排序）
+    order = np.lexsort((is_off, times))
+    times = times[order]
+    is_off = is_off[order]
+    pitches = pitches[order]
+    melody = melody[order]
+    
+    # 对已排序事件只扫描一遍，同时得到 Source 与 Target 的 TIME 偏移
+    target_deltas, source_deltas = _time_deltas(times, melody, time_quantization)
+    
+    # 生成 Source tokens (仅旋律) - 在已排序事件上筛选，无需再次排序
+    source_tokens = _events_to_tokens(
+        source_deltas[melody], pitches[melody], EVENT_TOKENS[1, is_off[melody]]
+    )
+    
+    # 生成 Target tokens (所有音符) - 旋律 10/11，伴奏 20/21
+    target_tokens = _events_to_tokens(
+        target_deltas, pitches, EVENT_TOKENS[melody.astype(np.intp), is_off]
+    )
+    
+    # 拼接训练序列: [1] + Source + [2] + Target + [3]
+    training_sequence = np.concatenate(([1], source_tokens, [2], target_tokens, [3]))
+    
+    return {
+        "source": source_tokens,
+        "target": target_tokens,
+        "training_sequence": training_sequence
+    }
+
+
+def midi_to_tokens(notes: Union[List[Dict], _NoteArrays], duration: float, time_quantization: int = 10, 
                    start_time: float = 0.0, end_time: float = None) -> Dict[str, List[int]]:
     """
     将 MIDI 音符转换为训练用的 Token 序列（纯数字格式）
@@ -314,7 +1015,7 @@ def midi_to_tokens(notes: List[Dict], duration: float, time_quantization: int =
     - 21, pitch: NOTE_OFF (伴奏)
     
     Args:
-        notes: 音符列表
+        notes: 音符列表（字典列表或 _NoteArrays）
         duration: MIDI 总时长
         time_quantization: 时间量化单位（毫秒），默认10ms提供更高精度
         start_time: 切片开始时间（用于切片）
@@ -323,85 +1024,26 @@ def midi_to_tokens(notes: List[Dict], duration: float, time_quantization: int =
     Returns:
         包含 source、target、training_sequence 的字典
     """
-    # 如果指定了切片时间，则进行切片
-    if end_time is not None:
-        notes = slice_notes_by_time(notes, start_time, end_time)
-    # 创建事件列表
-    all_events = []
-    melody_events = []
-    
-    for note in notes:
-        # NOTE_ON 事件
-        event_on = {
-            'time': note['start'],
-            'type': 'note_on',
-            'pitch': note['pitch'],
-            'velocity': note['velocity'],
-            'is_melody': note['is_melody']
-        }
-        # NOTE_OFF 事件
-        event_off = {
-            'time': note['end'],
-            'type': 'note_off',
-            'pitch': note['pitch'],
-            'velocity': 0,
-            'is_melody': note['is_melody']
-        }
-        
-        all_events.append(event_on)
-        all_events.append(event_off)
-        
-        # 只添加旋律到melody_events
-        if note['is_melody']:
-            melody_events.append(event_on)
-            melody_events.append(event_off)
-    
-    # 按时间排序
-    all_events.sort(key=lambda x: (x['time'], x['type'] == 'note_off'))
-    melody_events.sort(key=lambda x: (x['time'], x['type'] == 'note_off'))
-    
-    # 生成 Source tokens (仅旋律) - 纯数字格式
-    source_tokens = []
-    current_time = 0
-    for event in melody_events:
-        time_delta = int((event['time'] - current_time) * 1000 / time_quantization)
-        if time_delta > 0:
-            source_tokens.extend([0, time_delta])  # TIME事件
-            current_time = event['time']
-        
-        if event['type'] == 'note_on':
-            source_tokens.extend([10, event['pitch']])  # NOTE_ON (旋律)
-        else:
-            source_tokens.extend([11, event['pitch']])  # NOTE_OFF (旋律)
-    
-    # 生成 Target tokens (所有音符) - 纯数字格式
-    target_tokens = []
-    current_time = 0
-    for event in all_events:
-        time_delta = int((event['time'] - current_time) * 1000 / time_quantization)
-        if time_delta > 0:
-            target_tokens.extend([0, time_delta])  # TIME事件
-            current_time = event['time']
-        
-        if event['is_melody']:
-            if event['type'] == 'note_on':
-                target_tokens.extend([10, event['pitch']])  # NOTE_ON (旋律)
-            else:
-                target_tokens.extend([11, event['pitch']])  # NOTE_OFF (旋律)
-        else:
-            if event['type'] == 'note_on':
-                target_tokens.extend([20, event['pitch']])  # NOTE_ON (伴奏)
-            else:
-                target_tokens.extend([21, event['pitch']])  # NOTE_OFF (伴奏)
-    
-    # 拼接训练序列: [1] + Source + [2] + Target + [3]
-    training_sequence = [1] + source_tokens + [2] + target_tokens + [3]
+    token_arrays = _midi_to_token_arrays(notes, time_quantization, start_time, end_time)
+    return {key: tokens.tolist() for key, tokens in token_arrays.items()}
+
+
+def _warm_up_jit() -> None:
+    """
+    预先编译 numba 函数，避免首个请求承担数秒的编译时间（numba 不可用时不做任何事）
     
-    return {
-        "source": source_tokens,
-        "target": target_tokens,
-        "training_sequence": training_sequence
-    }
+    用两个音符走一遍 Token 化、解码与 MIDI 编码的完整路径，编译时的参数类型与实际请求一致；
+    cache=True 会把编译结果写入磁盘，之后启动的进程直接加载
+    """
+    if numba is None:
+        return
+    arrays = _NoteArrays.from_dicts([
+        {"start": 0.0, "end": 0.5, "pitch": 60, "velocity": 80, "is_melody": True},
+        {"start": 0.25, "end": 1.0, "pitch": 48, "velocity": 64, "is_melody": False},
+    ])
+    training_sequence = _midi_to_token_arrays(arrays)["training_sequence"]
+    tokens_to_notes(training_sequence)
+    tokens_to_midi_bytes(training_sequence)
 
 
 def skyline_algorithm(notes: List[Dict], time_window: float = 0.05) -> List[Dict]:
@@ -418,94 +1060,283 @@ def skyline_algorithm(notes: List[Dict], time_window: float = 0.05) -> List[Dict
     if not notes:
         return notes
     
-    # 获取最大结束时间
-    max_time = max(note['end'] for note in notes)
+    arrays = skyline_algorithm_np(_NoteArrays.from_dicts(notes), time_window)
     
-    # 遍历每个时间窗口
-    current_time = 0
-    while current_time < max_time:
-        window_end = current_time + time_window
-        
-        # 找到当前窗口内的所有音符
-        notes_in_window = [
-            note for note in notes
-            if note['start'] < window_end and note['end'] > current_time
-        ]
-        
-        if notes_in_window:
-            # 找到最高音
-            max_pitch = max(note['pitch'] for note in notes_in_window)
-            
-            # 标记最高音为旋律
-            for note in notes_in_window:
-                if note['pitch'] == max_pitch:
-                    note['is_melody'] = True
-        
-        current_time += time_window
+    for idx in np.flatnonzero(arrays.is_melody).tolist():
+        notes[idx]['is_melody'] = True
     
     return notes
 
 
+# Skyline 每块处理的窗口数（按块计算 (音高, 窗口) 矩阵以控制内存占用）
+SKYLINE_WINDOW_TILE = 1024
+
+
+def skyline_algorithm_np(arrays: _NoteArrays, time_window: float = 0.05) -> _NoteArrays:
+    """
+    Skyline 算法（SoA 版本）：直接在数组上标注主旋律
+    
+    Args:
+        arrays: 音符数组，is_melody 会被原地更新
+        time_window: 时间窗口大小（秒）
+    
+    Returns:
+        标注后的音符数组
+    """
+    if len(arrays) == 0:
+        return arrays
+    
+    starts = arrays.starts
+    ends = arrays.ends
+    pitches = arrays.pitches
+    
+    # 扫描到最大结束时间为止，之后的窗口没有音符
+    max_time = float(ends.max())
+    
+    # 预先生成所有窗口边界：np.add.accumulate 为顺序累加，与逐窗口 += 的浮点结果一致
+    estimate = max(int(np.ceil(max_time / time_window)), 0) + 2
+    window_starts = np.concatenate(([0.0], np.add.accumulate(np.full(estimate, time_window))))
+    num_windows = int(np.searchsorted(window_starts, max_time, side='left'))
+    window_starts = window_starts[:num_windows]
+    window_ends = window_starts + time_window
+    
+    # 每个音符覆盖的窗口区间 [lo, hi)
+    lo = np.searchsorted(window_ends, starts, side='right')
+    hi = np.minimum(np.searchsorted(window_starts, ends, side='left'), num_windows)
+    valid = np.flatnonzero(lo < hi)
+    if len(valid) == 0:
+        return arrays
+    lo = lo[valid]
+    hi = hi[valid]
+    
+    # 音高压缩为秩（MIDI 最多128个不同音高），按 (音高, 窗口) 累计开/关计数：
+    # 每个事件 O(1) 更新，差分数组前缀和即为各窗口中每个音高的活跃音符数
+    levels, ranks = np.unique(pitches[valid], return_inverse=True)
+    num_levels = len(levels)
+    
+    # 长曲目的 (音高, 窗口) 矩阵可达数十 MB，按窗口分块计算以留在缓存中；
+    # 块间只需传递每个音高的活跃计数
+    lo_order = np.argsort(lo, kind='stable')
+    hi_order = np.argsort(hi, kind='stable')
+    lo_sorted = lo[lo_order]
+    hi_sorted = hi[hi_order]
+    tile_bounds = np.append(np.arange(0, num_windows, SKYLINE_WINDOW_TILE), num_windows)
+    lo_cuts = np.searchsorted(lo_sorted, tile_bounds, side='left')
+    hi_cuts = np.searchsorted(hi_sorted, tile_bounds, side='left')
+    
+    # 每个窗口中最高的活跃音高（秩）；没有音符的窗口为 -1
+    top = np.empty(num_windows, dtype=np.intp)
+    active = np.zeros(num_levels, dtype=np.int64)
+    for t in range(len(tile_bounds) - 1):
+        tile_start, tile_end = int(tile_bounds[t]), int(tile_bounds[t + 1])
+        width = tile_end - tile_start
+        on = lo_order[lo_cuts[t]:lo_cuts[t + 1]]
+        off = hi_order[hi_cuts[t]:hi_cuts[t + 1]]
+        size = num_levels * width
+        diff = (np.bincount(ranks[on] * width + (lo[on] - tile_start), minlength=size)
+                - np.bincount(ranks[off] * width + (hi[off] - tile_start), minlength=size))
+        counts = np.cumsum(diff.reshape(num_levels, width), axis=1)
+        counts += active[:, None]
+        active = counts[:, -1].copy()
+        covered = counts > 0
+        tile_top = num_levels - 1 - np.argmax(covered[::-1], axis=0)
+        tile_top[~covered.any(axis=0)] = -1
+        top[tile_start:tile_end] = tile_top
+    
+    # 音符覆盖范围内每个窗口的最高音都不低于它本身，
+    # 因此"某个窗口中它是最高音"等价于"范围内最高音的最小值等于它的音高"
+    # reduceat 按 [lo, hi) 成对归约，末尾哨兵使 hi == num_windows 时下标合法
+    bounds = np.empty(2 * len(valid), dtype=np.intp)
+    bounds[0::2] = lo
+    bounds[1::2] = hi
+    range_min = np.minimum.reduceat(np.append(top, num_levels), bounds)[0::2]
+    
+    arrays.is_melody[valid[range_min == ranks]] = True
+    
+    return arrays
+
+
 @app.get("/")
 async def root():
     """健康检查"""
     return {"message": "Melody Annotator API is running"}
 
 
+def _parse_and_annotate(content: bytes) -> bytes:
+    """
+    解析 MIDI 文件内容、应用 Skyline 算法，返回序列化后的 JSON 响应体
+    
+    Args:
+        content: MIDI 文件的原始字节
+    
+    Returns:
+        {"duration", "notes"} 的 JSON 字节串
+    """
+    # 直接从内存读取 MIDI，无需写入临时文件
+    midi_data = pretty_midi.PrettyMIDI(io.BytesIO(content))
+    
+    # 收集所有非打击乐音符（SoA 数组）
+    arrays = _NoteArrays.from_instruments(
+        [instrument for instrument in midi_data.instruments if not instrument.is_drum]
+    )
+    
+    # 应用 Skyline 算法：扫描范围取音符的最大结束时间，而非 get_end_time()
+    # （后者包含打击乐、控制器与元事件，可能远长于音符实际覆盖的范围）
+    skyline_algorithm_np(arrays)
+    duration = float(midi_data.get_end_time())
+    
+    return _dump_json({
+        "duration": duration,
+        "notes": arrays.to_dicts()
+    })
+
+
+async def _run_in_executor(fn, *args):
+    """
+    在进程池中执行 CPU 密集函数（fn 必须是可 pickle 的模块级函数）
+    
+    工作进程异常退出会使进程池永久不可用：此时换上新的进程池，
+    本次请求仍按失败处理（不重试可能导致进程崩溃的输入）
+    """
+    global EXECUTOR
+    if EXECUTOR is None:
+        EXECUTOR = _new_executor()
+    executor = EXECUTOR
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    except BrokenProcessPool:
+        # 并发请求可能同时发现进程池损坏，只替换一次
+        if EXECUTOR is executor:
+            EXECUTOR = _new_executor()
+            executor.shutdown(wait=False)
+        raise
+
+
+async def _cached_parse_and_annotate(content: bytes) -> bytes:
+    """
+    按文件内容哈希缓存 _parse_and_annotate 的结果（LRU，同时受条目数与总字节数限制）
+    
+    同一文件的并发上传会等待正在进行的那一次计算，而不是重复计算；
+    若那一次计算的请求被取消，等待者会自行重新计算
+    """
+    global _upload_cache_bytes
+    key = hashlib.blake2b(content, digest_size=16).digest()
+    
+    cached = _upload_cache.get(key)
+    if cached is not None:
+        _upload_cache.move_to_end(key)
+        return cached
+    
+    pending = _upload_pending.get(key)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            return await _cached_parse_and_annotate(content)
+    
+    future = asyncio.get_running_loop().create_future()
+    _upload_pending[key] = future
+    try:
+        body = await _run_in_executor(_parse_and_annotate, content)
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # 标记异常已读取，避免无人等待时 asyncio 报警告
+        raise
+    else:
+        future.set_result(body)
+        if len(body) <= UPLOAD_CACHE_ENTRY_MAX_BYTES:
+            _upload_cache[key] = body
+            _upload_cache_bytes += len(body)
+            while len(_upload_cache) > UPLOAD_CACHE_SIZE or _upload_cache_bytes > UPLOAD_CACHE_MAX_BYTES:
+                _, evicted = _upload_cache.popitem(last=False)
+                _upload_cache_bytes -= len(evicted)
+        return body
+    finally:
+        # 发起计算的请求被取消（CancelledError 不经过 except Exception）时通知等待者
+        if not future.done():
+            future.cancel()
+        del _upload_pending[key]
+
+
 @app.post("/upload")
 async def upload_midi(file: UploadFile = File(...)):
     """
     上传 MIDI 文件并返回分析后的音符数据
     """
+    # 上传已由 Starlette 暂存到临时文件：最多读入上限多一个字节，超出即拒绝，不把整个文件读入内存
+    content = await file.read(MAX_MIDI_BYTES + 1)
+    if len(content) > MAX_MIDI_BYTES:
+        raise HTTPException(status_code=413, detail=f"MIDI 文件过大（上限 {MAX_MIDI_BYTES // (1024 * 1024)}MB）")
+    
     try:
-        # 保存上传的文件到临时目录
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mid') as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_path = tmp_file.name
-        
-        # 使用 pretty_midi 读取 MIDI 文件
-        midi_data = pretty_midi.PrettyMIDI(tmp_path)
-        
-        # 收集所有音符
-        all_notes = []
-        note_id = 0
-        
-        for instrument in midi_data.instruments:
-            # 跳过打击乐器
-            if instrument.is_drum:
-                continue
-            
-            for note in instrument.notes:
-                all_notes.append({
-                    'id': note_id,
-                    'start': float(note.start),
-                    'end': float(note.end),
-                    'pitch': int(note.pitch),
-                    'velocity': int(note.velocity),
-                    'is_melody': False  # 默认不是旋律
-                })
-                note_id += 1
-        
-        # 应用 Skyline 算法
-        all_notes = skyline_algorithm(all_notes)
-        
-        # 清理临时文件
-        os.unlink(tmp_path)
-        
-        return {
-            "duration": float(midi_data.get_end_time()),
-            "notes": all_notes
-        }
+        return _json_response(await _cached_parse_and_annotate(content))
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理 MIDI 文件时出错: {str(e)}")
 
 
+class _ChunkWriter(io.RawIOBase):
+    """只写、不可 seek 的流：收集写入的字节块（bytes 原样保留、不复制），供生成器分段取出"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(data if isinstance(data, bytes) else bytes(data))
+        return len(data)
+    
+    def drain(self) -> List[bytes]:
+        """取出并清空目前为止写入的字节块"""
+        chunks = self._chunks
+        self._chunks = []
+        return chunks
+
+
+def _midi_file_bytes(midi: pretty_midi.PrettyMIDI) -> bytes:
+    """将 MIDI 对象编码为 MIDI 文件字节"""
+    midi_buffer = io.BytesIO()
+    midi.write(midi_buffer)
+    return midi_buffer.getvalue()
+
+
+def _stream_zip(members: List[Tuple[str, bytes]], compression: int,
+                compresslevel: Optional[int] = None) -> Iterator[bytes]:
+    """
+    逐个将已编码的 MIDI 写入 ZIP 条目，每写完一个条目就输出已生成的字节块
+    
+    ZIP_STORED 时条目数据即为传入的 MIDI 字节对象本身，直接输出而不再复制
+    
+    Args:
+        members: (文件名, MIDI 文件字节) 列表
+        compression: zipfile 压缩方式
+        compresslevel: 压缩级别
+    
+    Yields:
+        ZIP 文件的字节块
+    """
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, 'w', compression, compresslevel=compresslevel) as zip_file:
+        for name, data in members:
+            with zip_file.open(name, 'w') as entry:
+                entry.write(data)
+            yield from writer.drain()
+    # 中央目录在关闭 ZIP 时写入
+    yield from writer.drain()
+
+
 @app.post("/export")
-async def export_midi(request: ExportRequest):
+async def export_midi(request: ExportRequest, compress: bool = False):
     """
     导出分轨后的 MIDI 文件（旋律 + 原始MIDI）
+    
+    MIDI 本身已很紧凑，默认以 ZIP_STORED 打包不压缩；
+    传入 ?compress=1 时使用最快级别的 DEFLATE 压缩
     """
     try:
         # 创建两个 MIDI 对象
@@ -516,60 +1347,103 @@ async def export_midi(request: ExportRequest):
         melody_instrument = pretty_midi.Instrument(program=0, name="Melody")
         original_instrument = pretty_midi.Instrument(program=0, name="Piano")
         
-        # 分配音符到不同轨道
-        for note_data in request.notes:
-            note = pretty_midi.Note(
-                velocity=note_data.velocity,
-                pitch=note_data.pitch,
-                start=note_data.start,
-                end=note_data.end
-            )
-            
-            # 旋律轨道：仅包含标记为旋律的音符
-            if note_data.is_melody:
-                melody_instrument.notes.append(note)
-            
-            # 原始轨道：包含所有音符
-            original_note = pretty_midi.Note(
-                velocity=note_data.velocity,
-                pitch=note_data.pitch,
-                start=note_data.start,
-                end=note_data.end
-            )
-            original_instrument.notes.append(original_note)
+        # 分配音符到不同轨道（一次性构建音符列表，避免逐个 append）
+        # 原始轨道：包含所有音符
+        original_instrument.notes = [
+            pretty_midi.Note(velocity=n.velocity, pitch=n.pitch, start=n.start, end=n.end)
+            for n in request.notes
+        ]
+        # 旋律轨道：仅包含标记为旋律的音符（写出时只读取音符，两个轨道共用同一对象）
+        melody_instrument.notes = [
+            note for note, n in zip(original_instrument.notes, request.notes) if n.is_melody
+        ]
         
         # 添加乐器到 MIDI
         melody_midi.instruments.append(melody_instrument)
         original_midi.instruments.append(original_instrument)
         
-        # 创建 ZIP 文件
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # 写入旋律 MIDI
-            melody_buffer = io.BytesIO()
-            melody_midi.write(melody_buffer)
-            zip_file.writestr('melody.mid', melody_buffer.getvalue())
-            
-            # 写入原始 MIDI
-            original_buffer = io.BytesIO()
-            original_midi.write(original_buffer)
-            zip_file.writestr('original.mid', original_buffer.getvalue())
-        
-        # 重置指针
-        zip_buffer.seek(0)
+        # 在 try 内完成 MIDI 编码，编码错误（如音高越界）仍以 500 返回；
+        # 之后仅流式输出 ZIP 封装，不在内存中保留整个 ZIP
+        members = [('melody.mid', _midi_file_bytes(melody_midi)),
+                   ('original.mid', _midi_file_bytes(original_midi))]
+        if compress:
+            zip_stream = _stream_zip(members, zipfile.ZIP_DEFLATED, compresslevel=1)
+        else:
+            zip_stream = _stream_zip(members, zipfile.ZIP_STORED)
         
         return StreamingResponse(
-            zip_buffer,
+            zip_stream,
             media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=separated_midi.zip"}
+            headers={
+                "Content-Disposition": "attachment; filename=separated_midi.zip",
+                "Content-Encoding": "identity",
+            }
         )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"导出 MIDI 文件时出错: {str(e)}")
 
 
+def _tokens_binary_response(token_arrays: Dict[str, np.ndarray]) -> Response:
+    """
+    将 training_sequence 编码为小端整数字节流
+    
+    Token 均为小整数，默认使用 int16；存在超出 int16 范围的值（如很大的 TIME 偏移、
+    负数音高）时改用 int32，实际类型与各部分长度通过响应头返回
+    """
+    sequence = token_arrays["training_sequence"]
+    int16 = np.iinfo(np.int16)
+    dtype = '<i2' if sequence.min() >= int16.min and sequence.max() <= int16.max else '<i4'
+    return Response(
+        content=sequence.astype(dtype).tobytes(),
+        media_type="application/octet-stream",
+        headers={
+            "X-Token-Count": str(len(sequence)),
+            "X-Token-Dtype": "int16" if dtype == '<i2' else "int32",
+            "X-Source-Length": str(len(token_arrays["source"])),
+            "X-Target-Length": str(len(token_arrays["target"]))
+        }
+    )
+
+
+def _tokenize_response(arrays: _NoteArrays, token_arrays: Dict[str, np.ndarray],
+                       duration: float, time_quantization: int, accept: str):
+    """
+    根据 Accept 请求头构建 /tokenize 与 /tokenize_bin 的响应
+    
+    Args:
+        arrays: 输入音符数组（用于统计）
+        token_arrays: _midi_to_token_arrays 的结果
+        duration: 总时长
+        time_quantization: 时间量化单位（毫秒）
+        accept: 请求的 Accept 头
+    """
+    # 二进制格式：training_sequence 以小端 int16 输出（TIME 偏移超出范围时用 int32）
+    if "application/octet-stream" in accept:
+        return _tokens_binary_response(token_arrays)
+    
+    # 统计信息
+    melody_count = int(arrays.is_melody.sum())
+    accomp_count = len(arrays) - melody_count
+    
+    # Token 数组由 orjson 直接序列化，无需先转换为 Python 列表
+    return _json_response({
+        "source_tokens": token_arrays["source"],
+        "target_tokens": token_arrays["target"],
+        "training_sequence": token_arrays["training_sequence"],
+        "source_length": len(token_arrays["source"]),
+        "target_length": len(token_arrays["target"]),
+        "total_length": len(token_arrays["training_sequence"]),
+        "note_count": len(arrays),
+        "melody_count": melody_count,
+        "accompaniment_count": accomp_count,
+        "duration": duration,
+        "time_quantization_ms": time_quantization
+    })
+
+
 @app.post("/tokenize")
-async def tokenize_midi(request: TokenizeRequest):
+async def tokenize_midi(request: TokenizeRequest, accept: str = Header(default="")):
     """
     将 MIDI 数据转换为训练用 Token 序列
     
@@ -577,40 +1451,84 @@ async def tokenize_midi(request: TokenizeRequest):
     - source: 仅旋律的token序列
     - target: 完整（旋律+伴奏）的token序列
     - training_sequence: <BOS> [Source] <SEP> [Target] <EOS>
+    
+    请求头 Accept: application/octet-stream 时，直接返回 training_sequence 的
+    小端 int16 字节流（见 _tokens_binary_response）
     """
     try:
-        # 转换为字典格式
-        notes_dict = [note.dict() for note in request.notes]
+        # 直接读取模型属性构建数组（不逐个 .dict()），传给进程池时序列化开销也更小
+        arrays = _NoteArrays.from_models(request.notes)
         
-        # 生成 Token
-        token_result = midi_to_tokens(
-            notes_dict,
-            request.duration,
+        # 生成 Token（在进程池中执行，不阻塞事件循环）
+        token_arrays = await _run_in_executor(
+            _midi_to_token_arrays,
+            arrays,
             request.time_quantization
         )
         
-        # 统计信息
-        melody_count = sum(1 for n in request.notes if n.is_melody)
-        accomp_count = len(request.notes) - melody_count
-        
-        return {
-            "source_tokens": token_result["source"],
-            "target_tokens": token_result["target"],
-            "training_sequence": token_result["training_sequence"],
-            "source_length": len(token_result["source"]),
-            "target_length": len(token_result["target"]),
-            "total_length": len(token_result["training_sequence"]),
-            "note_count": len(request.notes),
-            "melody_count": melody_count,
-            "accompaniment_count": accomp_count,
-            "duration": request.duration,
-            "time_quantization_ms": request.time_quantization
-        }
+        return _tokenize_response(arrays, token_arrays, request.duration, request.time_quantization, accept)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Token化时出错: {str(e)}")
+
+
+@app.post("/tokenize_bin")
+async def tokenize_midi_binary(request: Request):
+    """
+    /tokenize 的二进制请求版本：跳过逐音符的 Pydantic 校验，直接解析为数组
+    
+    请求体为小端二进制：TOKENIZE_BIN_HEADER（音符数、时间量化、总时长）
+    后接五个并列数组（见 _NoteArrays.from_buffer）。响应与 /tokenize 相同
+    """
+    raw = await request.body()
+    
+    # 请求格式错误返回 400（在 try 之外，避免被转换为 500）
+    if len(raw) < TOKENIZE_BIN_HEADER.size:
+        raise HTTPException(status_code=400, detail="请求体缺少二进制头部")
+    note_count, time_quantization, duration = TOKENIZE_BIN_HEADER.unpack_from(raw)
+    if time_quantization == 0:
+        raise HTTPException(status_code=400, detail="time_quantization 必须为正整数")
+    try:
+        arrays = _NoteArrays.from_buffer(raw, note_count, TOKENIZE_BIN_HEADER.size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"二进制音符数据格式错误: {str(e)}")
+    
+    try:
+        # 生成 Token（在进程池中执行，不阻塞事件循环）
+        token_arrays = await _run_in_executor(_midi_to_token_arrays, arrays, time_quantization)
+        
+        return _tokenize_response(arrays, token_arrays, duration, time_quantization,
+                                  request.headers.get("accept", ""))
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Token化时出错: {str(e)}")
 
 
+def _tokenize_slices(arrays: _NoteArrays, slices: List[Tuple[float, float]],
+                     time_quantization: int) -> List[Dict[str, np.ndarray]]:
+    """
+    对一批切片生成 Token（在进程池 worker 中执行）
+    
+    Args:
+        arrays: 覆盖这批切片时间范围的候选音符（保持原始顺序）
+        slices: [(start_time, end_time), ...]
+        time_quantization: 时间量化单位（毫秒）
+    
+    Returns:
+        每个切片的 _midi_to_token_arrays 结果
+    """
+    start_index = _StartIndex.from_arrays(arrays)
+    return [
+        _midi_to_token_arrays(
+            arrays.take(start_index.candidates(start_time, end_time)),
+            time_quantization,
+            start_time,
+            end_time
+        )
+        for start_time, end_time in slices
+    ]
+
+
 @app.post("/tokenize_sliced")
 async def tokenize_midi_sliced(request: TokenizeSlicedRequest):
     """
@@ -622,8 +1540,10 @@ async def tokenize_midi_sliced(request: TokenizeSlicedRequest):
     返回多个样本，适合模型训练
     """
     try:
-        # 转换为字典格式
-        notes_dict = [note.dict() for note in request.notes]
+        # 直接读取模型属性构建数组（不逐个 .dict()）；
+        # 按开始时间排序一次，每个切片只需处理二分查找得到的候选音符
+        arrays = _NoteArrays.from_models(request.notes)
+        start_index = _StartIndex.from_arrays(arrays)
         
         # 计算切片数量
         slice_duration = request.slice_duration
@@ -631,39 +1551,50 @@ async def tokenize_midi_sliced(request: TokenizeSlicedRequest):
         step = slice_duration - overlap
         num_slices = int(np.ceil((request.duration - overlap) / step))
         
-        samples = []
-        
+        slices = []
         for i in range(num_slices):
             start_time = i * step
             end_time = min(start_time + slice_duration, request.duration)
-            
-            # 生成该切片的Token
-            token_result = midi_to_tokens(
-                notes_dict,
-                request.duration,
-                request.time_quantization,
-                start_time,
-                end_time
-            )
-            
-            # 只保留有内容的切片
-            if len(token_result["source"]) > 0 or len(token_result["target"]) > 0:
+            slices.append((start_time, end_time))
+        
+        # 切片之间相互独立：按 CPU 核数分批并行生成 Token，
+        # 每批只传入与其时间范围相交的候选音符，而不是每个切片都序列化全部音符
+        batch_size = max(1, -(-len(slices) // (os.cpu_count() or 1)))
+        jobs = []
+        for b in range(0, len(slices), batch_size):
+            batch = slices[b:b + batch_size]
+            batch_start = min(start_time for start_time, _ in batch)
+            batch_end = max(end_time for _, end_time in batch)
+            jobs.append(_run_in_executor(
+                _tokenize_slices,
+                arrays.take(start_index.candidates(batch_start, batch_end)),
+                batch,
+                request.time_quantization
+            ))
+        batch_results = await asyncio.gather(*jobs)
+        slice_tokens = [token_arrays for batch in batch_results for token_arrays in batch]
+        
+        samples = []
+        
+        for i, ((start_time, end_time), token_arrays) in enumerate(zip(slices, slice_tokens)):
+            # 只保留有内容的切片（training_sequence 保持为数组，由 orjson 直接序列化）
+            if len(token_arrays["source"]) > 0 or len(token_arrays["target"]) > 0:
                 samples.append({
                     "slice_id": i,
                     "start_time": start_time,
                     "end_time": end_time,
                     "duration": end_time - start_time,
-                    "training_sequence": token_result["training_sequence"],
-                    "source_length": len(token_result["source"]),
-                    "target_length": len(token_result["target"]),
-                    "total_length": len(token_result["training_sequence"])
+                    "training_sequence": token_arrays["training_sequence"],
+                    "source_length": len(token_arrays["source"]),
+                    "target_length": len(token_arrays["target"]),
+                    "total_length": len(token_arrays["training_sequence"])
                 })
         
         # 统计信息
-        melody_count = sum(1 for n in request.notes if n.is_melody)
-        accomp_count = len(request.notes) - melody_count
+        melody_count = int(arrays.is_melody.sum())
+        accomp_count = len(arrays) - melody_count
         
-        return {
+        return _json_response({
             "samples": samples,
             "num_samples": len(samples),
             "slice_duration": slice_duration,
@@ -675,7 +1606,7 @@ async def tokenize_midi_sliced(request: TokenizeSlicedRequest):
             "time_quantization_ms": request.time_quantization,
             "avg_sample_length": int(np.mean([s["total_length"] for s in samples])) if samples else 0,
             "max_sample_length": max([s["total_length"] for s in samples]) if samples else 0
-        }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"切片Token化时出错: {str(e)}")
@@ -695,15 +1626,11 @@ async def json_to_midi(request: JsonToMidiRequest):
         # 创建乐器轨道
         instrument = pretty_midi.Instrument(program=0, name="Piano")
         
-        # 添加所有音符
-        for note_data in request.notes:
-            note = pretty_midi.Note(
-                velocity=note_data.velocity,
-                pitch=note_data.pitch,
-                start=note_data.start,
-                end=note_data.end
-            )
-            instrument.notes.append(note)
+        # 添加所有音符（一次性构建音符列表，避免逐个 append）
+        instrument.notes = [
+            pretty_midi.Note(velocity=n.velocity, pitch=n.pitch, start=n.start, end=n.end)
+            for n in request.notes
+        ]
         
         # 添加乐器到 MIDI
         midi.instruments.append(instrument)
@@ -731,38 +1658,14 @@ async def tokens_to_midi(request: TokensToMidiRequest):
     接受training_sequence或任何token序列，逆转换为MIDI
     """
     try:
-        # 将tokens转换为音符列表
-        notes = tokens_to_notes(request.training_sequence, request.time_quantization)
+        # 将tokens直接编码为MIDI字节（不经过音符字典和 pretty_midi.Note 对象）
+        midi_bytes = tokens_to_midi_bytes(request.training_sequence, request.time_quantization)
         
-        if not notes:
+        if midi_bytes is None:
             raise HTTPException(status_code=400, detail="无法从Token序列中解析出有效音符")
         
-        # 创建 MIDI 对象
-        midi = pretty_midi.PrettyMIDI()
-        
-        # 创建乐器轨道
-        instrument = pretty_midi.Instrument(program=0, name="Piano")
-        
-        # 添加所有音符
-        for note_data in notes:
-            note = pretty_midi.Note(
-                velocity=note_data['velocity'],
-                pitch=note_data['pitch'],
-                start=note_data['start'],
-                end=note_data['end']
-            )
-            instrument.notes.append(note)
-        
-        # 添加乐器到 MIDI
-        midi.instruments.append(instrument)
-        
-        # 写入到内存
-        midi_buffer = io.BytesIO()
-        midi.write(midi_buffer)
-        midi_buffer.seek(0)
-        
-        return StreamingResponse(
-            midi_buffer,
+        return Response(
+            content=midi_bytes,
             media_type="audio/midi",
             headers={"Content-Disposition": f"attachment; filename={request.filename}"}
         )
@@ -785,10 +1688,10 @@ async def tokens_to_notes_endpoint(request: TokensToMidiRequest):
         if not notes:
             raise HTTPException(status_code=400, detail="无法从Token序列中解析出有效音符")
         
-        return {
+        return _json_response({
             "notes": notes,
             "count": len(notes)
-        }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Token解析时出错: {str(e)}")
@@ -805,10 +1708,10 @@ async def tokens_to_notes_target_only(request: TokensToMidiRequest):
     本接口只返回Target部分的音符
     """
     try:
-        # 提取Target部分
+        # 提取Target部分（一次转换为数组，之后均为零拷贝视图）
         target_tokens = extract_target_tokens(request.training_sequence)
         
-        if not target_tokens:
+        if len(target_tokens) == 0:
             raise HTTPException(status_code=400, detail="无法从训练序列中提取Target部分")
         
         # 转换为音符
@@ -817,11 +1720,11 @@ async def tokens_to_notes_target_only(request: TokensToMidiRequest):
         if not notes:
             raise HTTPException(status_code=400, detail="无法从Token序列中解析出有效音符")
         
-        return {
+        return _json_response({
             "notes": notes,
             "count": len(notes),
             "target_token_count": len(target_tokens)
-        }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Token解析时出错: {str(e)}")
@@ -829,4 +1732,8 @@ async def tokens_to_notes_target_only(request: TokensToMidiRequest):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import importlib.util
+    # uvloop 不支持 Windows，缺失时退回 asyncio 事件循环
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop, http=http)
@@ -12,6 +12,8 @@
 
 import json
 import sys
+from functools import lru_cache
+import numpy as np
 import pretty_midi
 
 # 导入主程序的tokens_to_notes函数
@@ -19,6 +21,16 @@ sys.path.append('.')
 from main import tokens_to_notes
 
 
+@lru_cache(maxsize=512)
+def _tokens_to_notes_cached(tokens: tuple, time_quantization: int):
+    """
+    按 Token 内容缓存 tokens_to_notes 的结果，重叠切片中重复的 Target 只解析一次
+    
+    返回的列表为缓存共享对象，调用方只读取、不修改
+    """
+    return tokens_to_notes(list(tokens), time_quantization=time_quantization)
+
+
 def reconstruct_midi_from_slices(json_file='tokens_sliced.json', output_file='merged_fixed.mid'):
     """
     从切片Token JSON文件重建完整MIDI
@@ -61,27 +73,26 @@ def reconstruct_midi_from_slices(json_file='tokens_sliced.json', output_file='me
         print(f"\nProcessing slice {slice_id}: {start_time:.1f}s - {end_time:.1f}s")
         
         # --- 关键步骤A: 只提取Target部分 ---
-        seq = sample['training_sequence']
+        seq = np.asarray(sample['training_sequence'])
         
-        try:
-            # 找到分隔符<SEP> (Token ID=2)的位置
-            sep_index = seq.index(2)
-            
-            # 只取SEP之后的内容（这是完整编曲的Target部分）
-            target_tokens = seq[sep_index + 1:]
-            
-            # 去掉末尾的<EOS> (Token ID=3)
-            if target_tokens and target_tokens[-1] == 3:
-                target_tokens = target_tokens[:-1]
-            
-            print(f"  Extracted {len(target_tokens)} target tokens (after SEP)")
-            
-        except ValueError:
+        # 找到分隔符<SEP> (Token ID=2)的位置
+        is_sep = seq == 2
+        if not is_sep.any():
             print(f"  WARNING: Slice {slice_id} has no SEP token, skipping!")
             continue
+        sep_index = int(np.argmax(is_sep))
+        
+        # 只取SEP之后的内容（这是完整编曲的Target部分），切片为视图不复制
+        target_tokens = seq[sep_index + 1:]
+        
+        # 去掉末尾的<EOS> (Token ID=3)
+        if len(target_tokens) and target_tokens[-1] == 3:
+            target_tokens = target_tokens[:-1]
+        
+        print(f"  Extracted {len(target_tokens)} target tokens (after SEP)")
         
         # --- 转换Token -> Notes ---
-        notes_list = tokens_to_notes(target_tokens, time_quantization=time_quantization)
+        notes_list = _tokens_to_notes_cached(tuple(target_tokens.tolist()), time_quantization)
         
         if not notes_list:
             print(f"  WARNING: No notes generated from tokens")